@@ -1,35 +1,200 @@
 #!/usr/bin/env python3
-"""Clean up MongoDB analyses with missing video files."""
+"""Garbage-collect analysis records and uploaded files that no longer match.
+
+Two passes, both streamed in fixed-size batches so memory stays bounded:
+
+1. Records -> files: VideoAnalysis, BeatAnalysis, UserImages and Uploads
+   documents whose uploaded file is missing are removed with bulk deletes.
+   Older documents without a `file_name` field get it backfilled from their URL.
+2. Files -> records: files in uploads/ that no document references, along with
+   their stored feature files, are removed once older than --min-age-hours.
+   References are looked up with `$in` on the indexed `file_name` field.
+
+Run once (e.g. from cron) or pass --every to keep running on an interval.
+"""
+import argparse
 import os
-from pymongo import MongoClient
-from dotenv import load_dotenv
-
-load_dotenv()
-
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client["beatcanvas"]
-
-# Get all analyses
-analyses = list(db["VideoAnalysis"].find())
-print(f"Found {len(analyses)} total analyses")
-
-deleted_count = 0
-for analysis in analyses:
-    video_url = analysis.get("video_url", "")
-    # Extract filename from URL (e.g., "http://localhost:8000/uploads/file.mp4" -> "file.mp4")
-    if "/uploads/" in video_url:
-        filename = video_url.split("/uploads/")[-1]
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        
-        # Check if file exists
-        if not os.path.exists(file_path):
-            print(f"🗑️  Deleting analysis with missing file: {filename}")
-            db["VideoAnalysis"].delete_one({"_id": analysis["_id"]})
-            deleted_count += 1
-
-print(f"\n✅ Cleanup complete! Deleted {deleted_count} analyses with missing files.")
-print(f"📊 Remaining analyses: {db['VideoAnalysis'].count_documents({})}")
+import time
+import traceback
+from pymongo import UpdateOne
+from tasks import get_db, FEATURE_KINDS
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+UPLOAD_URL_PATH = "/uploads"
+
+# collection -> field holding the public upload URL
+URL_FIELDS = {
+    "VideoAnalysis": "video_url",
+    "BeatAnalysis": "audio_url",
+    "UserImages": "file_url",
+    "Uploads": "file_url",  # plain /upload-file uploads, e.g. composer exports
+}
+
+
+def upload_name_from_url(url):
+    marker = f"{UPLOAD_URL_PATH}/"
+    if not url or marker not in url:
+        return None
+    return os.path.basename(url.split(marker)[-1])
+
+
+def feature_owner(name):
+    """Return the upload a stored feature file belongs to, or None."""
+    for kind in FEATURE_KINDS:
+        suffix = f".{kind}.npy"
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+class Collector:
+    def __init__(self, db, batch_size=500, dry_run=False, max_deletes_per_sec=0, min_age_hours=24):
+        self.db = db
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.max_deletes_per_sec = max_deletes_per_sec
+        self.min_age_seconds = min_age_hours * 3600
+        self.stats = {"records_deleted": {name: 0 for name in URL_FIELDS}, "files_deleted": 0, "bytes_reclaimed": 0}
+        self.backfill_pending = 0
+
+    def _throttle(self, count):
+        if self.max_deletes_per_sec and count:
+            time.sleep(count / self.max_deletes_per_sec)
+
+    # --- Records -> files ---
+    def _flush_records(self, name, ids):
+        if not ids:
+            return
+        if not self.dry_run:
+            result = self.db[name].delete_many({"_id": {"$in": ids}})
+            self.stats["records_deleted"][name] += result.deleted_count
+        else:
+            self.stats["records_deleted"][name] += len(ids)
+        self._throttle(len(ids))
+        ids.clear()
+
+    def _flush_backfill(self, name, updates):
+        if updates:
+            self.db[name].bulk_write(updates, ordered=False)
+            updates.clear()
+
+    def collect_records(self):
+        for name, field in URL_FIELDS.items():
+            cursor = self.db[name].find({}, {field: 1, "file_name": 1}, batch_size=self.batch_size)
+            stale = []
+            backfill = []
+            for doc in cursor:
+                file_name = upload_name_from_url(doc.get(field))
+                if file_name and not os.path.exists(os.path.join(UPLOAD_DIR, file_name)):
+                    print(f"🗑️  {name} {doc['_id']} references missing file: {file_name}")
+                    stale.append(doc["_id"])
+                    if len(stale) >= self.batch_size:
+                        self._flush_records(name, stale)
+                elif file_name and doc.get("file_name") != file_name:
+                    if self.dry_run:
+                        self.backfill_pending += 1
+                        continue
+                    backfill.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"file_name": file_name}}))
+                    if len(backfill) >= self.batch_size:
+                        self._flush_backfill(name, backfill)
+            self._flush_records(name, stale)
+            self._flush_backfill(name, backfill)
+
+    # --- Files -> records ---
+    def _referenced(self, names):
+        """Return the subset of upload names referenced by any document."""
+        found = set()
+        for name in URL_FIELDS:
+            for doc in self.db[name].find({"file_name": {"$in": names}}, {"file_name": 1, "_id": 0}):
+                found.add(doc["file_name"])
+        return found
+
+    def _remove_file(self, entry):
+        size = entry.stat().st_size
+        print(f"🗑️  Orphaned file: {entry.name} ({size} bytes)")
+        if not self.dry_run:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                return
+        self.stats["files_deleted"] += 1
+        self.stats["bytes_reclaimed"] += size
+
+    def _flush_files(self, batch):
+        if not batch:
+            return
+        referenced = self._referenced(list({key for _, key in batch}))
+        orphans = [entry for entry, key in batch if key not in referenced]
+        for entry in orphans:
+            self._remove_file(entry)
+        self._throttle(len(orphans))
+        batch.clear()
+
+    def collect_files(self):
+        if not os.path.isdir(UPLOAD_DIR):
+            return
+        if self.backfill_pending:
+            # Without file_name those records look unreferenced; a real run backfills them first
+            print(f"⚠️  Skipping orphaned-file check: {self.backfill_pending} records still need a "
+                  f"file_name backfill (run once without --dry-run)")
+            return
+        cutoff = time.time() - self.min_age_seconds
+        batch = []
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.stat().st_mtime > cutoff:
+                    continue
+                # Feature files live and die with their upload
+                batch.append((entry, feature_owner(entry.name) or entry.name))
+                if len(batch) >= self.batch_size:
+                    self._flush_files(batch)
+        self._flush_files(batch)
+
+    def ensure_indexes(self):
+        for name in URL_FIELDS:
+            self.db[name].create_index("file_name")
+
+    def run(self):
+        if not self.dry_run:
+            self.ensure_indexes()
+        self.collect_records()
+        self.collect_files()
+        return self.stats
+
+
+def report(stats, dry_run):
+    prefix = "[dry run] Would reclaim" if dry_run else "Reclaimed"
+    records = ", ".join(f"{name}: {count}" for name, count in stats["records_deleted"].items())
+    print(f"\n✅ {prefix} {sum(stats['records_deleted'].values())} records ({records})")
+    print(f"✅ {prefix} {stats['files_deleted']} files, {stats['bytes_reclaimed'] / (1024 * 1024):.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted without deleting")
+    parser.add_argument("--batch-size", type=int, default=500, help="cursor batch and bulk delete size")
+    parser.add_argument("--max-deletes-per-sec", type=float, default=0, help="throttle deletes (0 = unlimited)")
+    parser.add_argument("--min-age-hours", type=float, default=24,
+                        help="only remove unreferenced files older than this")
+    parser.add_argument("--every", type=float, default=0, metavar="MINUTES",
+                        help="keep running, collecting every MINUTES (0 = run once)")
+    args = parser.parse_args()
+
+    while True:
+        try:
+            collector = Collector(get_db(), args.batch_size, args.dry_run, args.max_deletes_per_sec,
+                                  args.min_age_hours)
+            report(collector.run(), args.dry_run)
+        except Exception as e:
+            if not args.every:
+                raise
+            # Keep the schedule alive; the next run starts from scratch
+            print(f"❌ Cleanup run failed: {e}")
+            traceback.print_exc()
+        if not args.every:
+            break
+        time.sleep(args.every * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Generated media fixtures shared by test_transitions.py and loadtest.py."""
+import math
+import struct
+import wave
+
+
+def make_audio_fixture(path, seconds=5, bpm=120, rate=44100):
+    """Mono 16-bit click track."""
+    beat_every = int(rate * 60 / bpm)
+    click_len = int(rate * 0.02)
+    with wave.open(path, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        frames = bytearray()
+        for i in range(seconds * rate):
+            pos = i % beat_every
+            value = math.sin(2 * math.pi * 1000 * i / rate) * (1 - pos / click_len) if pos < click_len else 0.0
+            frames += struct.pack("<h", int(value * 20000))
+        out.writeframes(bytes(frames))
+
+
+def make_video_fixture(path, seconds=3, fps=30, size=(160, 120), cuts=None, fourcc="MJPG", scenes=None):
+    """Short clip with a hard cut at each frame index in `cuts` (default: every second).
+
+    `scenes` optionally gives the scene index shown after each cut, so a clip
+    can return to an earlier scene; by default every cut starts a new one.
+    """
+    import cv2
+    import numpy as np
+
+    cuts = sorted(range(fps, seconds * fps, fps) if cuts is None else cuts)
+    scenes = scenes or list(range(1, len(cuts) + 1))
+    rng = np.random.default_rng(0)
+    palette = [
+        cv2.resize(rng.integers(0, 255, (6, 8, 3), dtype=np.uint8), size, interpolation=cv2.INTER_NEAREST)
+        for _ in range(max(scenes) + 1)
+    ]
+    scene_at = dict(zip(cuts, scenes))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+    scene = palette[0]
+    for i in range(seconds * fps):
+        if i in scene_at:
+            scene = palette[scene_at[i]]
+        writer.write(scene)
+    writer.release()
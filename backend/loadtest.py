@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""End-to-end load test for the API, run in-process against main:app.
+
+Virtual users register in a burst at the start of each stage, then loop over a
+weighted mix of logins, video/audio uploads of generated fixtures, status
+polling (with If-None-Match) and gallery/analysis listing. Concurrency ramps
+through --stages; each stage reports throughput, p50/p95/p99 latency and error
+rate per route, plus event-loop lag. Background analysis threads started by
+uploads are joined at the end of each stage (the wait is reported separately)
+so their CPU load does not leak into the next stage.
+
+Uses the local MongoDB at MONGO_URI (in a separate `transition_studio_loadtest`
+database) when reachable, otherwise an in-memory mongomock stand-in. Results are
+written as sorted, indented JSON so runs can be diffed between commits.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+from fixtures import make_audio_fixture, make_video_fixture
+LOADTEST_DB = "transition_studio_loadtest"
+API = "/api/v1"
+
+# action -> relative weight in the request mix
+ACTIONS = {
+    "poll_status": 50,
+    "list_analyses": 15,
+    "list_gallery": 10,
+    "login": 5,
+    "upload_video": 5,
+    "upload_audio": 5,
+}
+
+
+# --- Backend setup ---
+def mongo_available(uri):
+    from pymongo import MongoClient
+    try:
+        MongoClient(uri, serverSelectionTimeoutMS=1000).server_info()
+        return True
+    except Exception:
+        return False
+
+
+def setup_backend(mongo_mode, upload_dir, skip_analysis, analysis_threads):
+    """Import main:app and point it at the load-test database and upload dir.
+
+    Background analysis threads are appended to `analysis_threads`.
+    """
+    import main
+    import tasks
+
+    if mongo_mode == "auto":
+        mongo_mode = "local" if mongo_available(main.MONGO_URI) else "mock"
+
+    if mongo_mode == "local":
+        from pymongo import MongoClient
+        sync_client = MongoClient(main.MONGO_URI)
+        main.app.mongodb = main.app.mongodb_client[LOADTEST_DB]
+    else:
+        import mongomock
+        from mongomock_motor import AsyncMongoMockClient
+        sync_client = mongomock.MongoClient()
+        main.app.mongodb = AsyncMongoMockClient(mock_mongo_client=sync_client)[LOADTEST_DB]
+
+    main.sync_db = sync_client[LOADTEST_DB]
+    tasks.get_db = lambda: sync_client[LOADTEST_DB]
+    main.UPLOAD_DIR = upload_dir
+    if skip_analysis:
+        main.start_background_task = lambda fn, *args: None
+    else:
+        def start_tracked_task(fn, *args):
+            thread = threading.Thread(target=fn, args=args, daemon=True)
+            analysis_threads.append(thread)
+            thread.start()
+        main.start_background_task = start_tracked_task
+
+    def drop():
+        sync_client.drop_database(LOADTEST_DB)
+
+    return main.app, mongo_mode, drop
+
+
+# --- Metrics ---
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize_ms(values):
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 2) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 2) if values else None,
+        "max_ms": round(max(values) * 1000, 2) if values else None,
+    }
+
+
+class StageRecorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.loop_lag = []
+
+    def record(self, route, seconds, ok):
+        self.latencies.setdefault(route, []).append(seconds)
+        self.errors.setdefault(route, 0)
+        if not ok:
+            self.errors[route] += 1
+
+    def summary(self, concurrency, elapsed):
+        routes = {}
+        for route, values in self.latencies.items():
+            routes[route] = {
+                "count": len(values),
+                "errors": self.errors[route],
+                "error_rate": round(self.errors[route] / len(values), 4),
+                "throughput_rps": round(len(values) / elapsed, 2),
+                **summarize_ms(values),
+            }
+        total = sum(len(v) for v in self.latencies.values())
+        errors = sum(self.errors.values())
+        return {
+            "concurrency": concurrency,
+            "duration_s": round(elapsed, 2),
+            "requests": total,
+            "errors": errors,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "throughput_rps": round(total / elapsed, 2),
+            "event_loop_lag": summarize_ms(self.loop_lag),
+            "routes": routes,
+        }
+
+
+async def monitor_loop_lag(recorder, stop, interval=0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        recorder.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+
+# --- Virtual users ---
+class VirtualUser:
+    def __init__(self, client, recorder, fixtures, rng, email, think_s):
+        self.client = client
+        self.recorder = recorder
+        self.fixtures = fixtures
+        self.rng = rng
+        self.email = email
+        self.password = "loadtest-password"
+        self.think_s = think_s
+        self.headers = {}
+        self.analysis_ids = []
+        self.etags = {}
+
+    async def request(self, route, method, url, ok_statuses=(200,), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            ok = response.status_code in ok_statuses
+        except Exception:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    async def authenticate(self, register):
+        path = "register" if register else "login"
+        response = await self.request(f"POST {API}/auth/{path}", "POST", f"{API}/auth/{path}",
+                                      json={"email": self.email, "password": self.password})
+        if response is not None:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def upload(self, kind):
+        name, content, mime = self.fixtures[kind]
+        response = await self.request(f"POST {API}/analyze-{kind}", "POST", f"{API}/analyze-{kind}",
+                                      headers=self.headers, files={"file": (name, content, mime)})
+        if response is not None:
+            self.analysis_ids.append(response.json()["id"])
+
+    async def poll_status(self):
+        if not self.analysis_ids:
+            return await self.list_analyses()
+        analysis_id = self.rng.choice(self.analysis_ids)
+        headers = dict(self.headers)
+        if analysis_id in self.etags:
+            headers["If-None-Match"] = self.etags[analysis_id]
+        response = await self.request(f"GET {API}/analyses/{{id}}", "GET", f"{API}/analyses/{analysis_id}",
+                                      ok_statuses=(200, 304), headers=headers)
+        if response is not None and "etag" in response.headers:
+            self.etags[analysis_id] = response.headers["etag"]
+
+    async def list_analyses(self):
+        await self.request(f"GET {API}/analyses", "GET", f"{API}/analyses", headers=self.headers)
+
+    async def list_gallery(self):
+        await self.request(f"GET {API}/user-images", "GET", f"{API}/user-images", headers=self.headers)
+
+    async def run(self, deadline):
+        await self.authenticate(register=True)
+        actions = {
+            "poll_status": self.poll_status,
+            "list_analyses": self.list_analyses,
+            "list_gallery": self.list_gallery,
+            "login": lambda: self.authenticate(register=False),
+            "upload_video": lambda: self.upload("video"),
+            "upload_audio": lambda: self.upload("audio"),
+        }
+        names, weights = list(ACTIONS), list(ACTIONS.values())
+        while time.perf_counter() < deadline:
+            await actions[self.rng.choices(names, weights)[0]]()
+            if self.think_s:
+                await asyncio.sleep(self.rng.uniform(0, self.think_s))
+
+
+def drain_analysis(analysis_threads):
+    """Wait for every background analysis thread started so far."""
+    while analysis_threads:
+        analysis_threads.pop().join()
+
+
+async def run_stages(app, fixtures, stages, stage_seconds, think_s, seed, analysis_threads):
+    import httpx
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=120) as client:
+        for stage_index, concurrency in enumerate(stages):
+            recorder = StageRecorder()
+            stop = asyncio.Event()
+            monitor = asyncio.create_task(monitor_loop_lag(recorder, stop))
+            start = time.perf_counter()
+            deadline = start + stage_seconds
+            users = [
+                VirtualUser(client, recorder, fixtures, random.Random(seed + stage_index * 10000 + i),
+                            f"vu-{seed}-{stage_index}-{i}@loadtest.example.com", think_s)
+                for i in range(concurrency)
+            ]
+            await asyncio.gather(*(user.run(deadline) for user in users))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await monitor
+            summary = recorder.summary(concurrency, elapsed)
+            drain_start = time.perf_counter()
+            await asyncio.to_thread(drain_analysis, analysis_threads)
+            summary["analysis_drain_s"] = round(time.perf_counter() - drain_start, 2)
+            results.append(summary)
+            print_stage(results[-1])
+    return results
+
+
+# --- Reporting ---
+def print_stage(stage):
+    lag = stage["event_loop_lag"]
+    print(f"\n📊 concurrency={stage['concurrency']}  {stage['throughput_rps']} req/s  "
+          f"errors={stage['error_rate'] * 100:.1f}%  loop lag p99={lag['p99_ms']}ms max={lag['max_ms']}ms  "
+          f"analysis drain={stage['analysis_drain_s']}s")
+    print(f"   {'route':<36} {'count':>6} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, stats in sorted(stage["routes"].items()):
+        print(f"   {route:<36} {stats['count']:>6} {stats['error_rate'] * 100:>6.1f} "
+              f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", choices=["auto", "local", "mock"], default="auto",
+                        help="local MongoDB, in-memory mongomock, or local if reachable (default)")
+    parser.add_argument("--stages", default="1,5,10,25", help="comma-separated concurrency levels to ramp through")
+    parser.add_argument("--stage-seconds", type=float, default=15, help="duration of each stage")
+    parser.add_argument("--think-ms", type=float, default=50, help="max random pause between user actions")
+    parser.add_argument("--skip-analysis", action="store_true",
+                        help="do not start background beat/transition analysis for uploads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="results file (default: loadtest_results/<commit>.json)")
+    parser.add_argument("--keep-data", action="store_true", help="keep the load-test database afterwards")
+    args = parser.parse_args()
+
+    stages = [int(n) for n in args.stages.split(",") if n.strip()]
+    upload_dir = tempfile.mkdtemp(prefix="beatcanvas-loadtest-")
+    fixture_dir = tempfile.mkdtemp(prefix="beatcanvas-fixtures-")
+    try:
+        make_video_fixture(os.path.join(fixture_dir, "clip.avi"))
+        make_audio_fixture(os.path.join(fixture_dir, "clicks.wav"))
+        fixtures = {}
+        for kind, name, mime in (("video", "clip.avi", "video/x-msvideo"), ("audio", "clicks.wav", "audio/wav")):
+            with open(os.path.join(fixture_dir, name), "rb") as f:
+                fixtures[kind] = (name, f.read(), mime)
+
+        analysis_threads = []
+        app, mongo_mode, drop_db = setup_backend(args.mongo, upload_dir, args.skip_analysis, analysis_threads)
+        print(f"✅ Load testing main:app with {mongo_mode} MongoDB, stages={stages}, {args.stage_seconds}s each")
+
+        results = asyncio.run(run_stages(app, fixtures, stages, args.stage_seconds, args.think_ms / 1000, args.seed,
+                                         analysis_threads))
+        if not args.keep_data:
+            drop_db()
+    finally:
+        shutil.rmtree(fixture_dir, ignore_errors=True)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "mongo": mongo_mode,
+            "python": sys.version.split()[0],
+            "seed": args.seed,
+            "skip_analysis": args.skip_analysis,
+            "stage_seconds": args.stage_seconds,
+            "think_ms": args.think_ms,
+            "mix": ACTIONS,
+        },
+        "stages": results,
+    }
+    out = args.out or os.path.join(BASE_DIR, "loadtest_results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"\n💾 Results saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
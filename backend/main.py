@@ -2,16 +2,22 @@ import uvicorn
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import Response
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError
 from bson import ObjectId
 from dotenv import load_dotenv
 from typing import Dict, Any, Optional
 import datetime
+import orjson
 import os
 import shutil
-from tasks import start_background_task, run_transition_analysis, run_madmom_beat_analysis
+from fastapi.concurrency import run_in_threadpool
+from tasks import (
+    start_background_task, run_transition_analysis, run_madmom_beat_analysis,
+    load_features, track_beats, validate_bpm_range, remove_upload, select_cuts, CUT_THRESHOLD, CANDIDATE_THRESHOLD,
+)
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from pydantic import BaseModel, EmailStr
@@ -104,6 +110,12 @@ app.add_middleware(
 app.mount(UPLOAD_URL_PATH, StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # --- Helper ---
+def mongo_utcnow() -> datetime.datetime:
+    """Current UTC time as Mongo stores and returns it (naive, millisecond precision),
+    so a document echoed after insert serializes the same as when read back."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
 def mongo_doc_to_json(doc: dict) -> dict:
     if not doc:
         return None
@@ -114,6 +126,33 @@ def mongo_doc_to_json(doc: dict) -> dict:
             doc[field] = doc[field].isoformat()
     return doc
 
+def upload_name_from_url(url: Optional[str]) -> Optional[str]:
+    """File name under UPLOAD_DIR for a public upload URL, whatever its host."""
+    marker = f"{UPLOAD_URL_PATH}/"
+    if not url or marker not in url:
+        return None
+    return os.path.basename(url.split(marker)[-1])
+
+def upload_path_from_url(url: Optional[str]) -> Optional[str]:
+    """Map a public upload URL back to its path under UPLOAD_DIR."""
+    file_name = upload_name_from_url(url)
+    return os.path.join(UPLOAD_DIR, file_name) if file_name else None
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Serialize with orjson, skipping FastAPI's jsonable_encoder pass."""
+    return Response(orjson.dumps(content), media_type="application/json", headers=headers)
+
+def analysis_etag(doc: dict) -> str:
+    """ETag for an analysis document; `version` is bumped on every update."""
+    return f'"{doc["_id"]}-{doc.get("version", 0)}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
 # --- API PREFIX ---
 API_PREFIX = "/api/v1"
 
@@ -178,21 +217,23 @@ async def analyze_video(file: UploadFile = File(...), request: Request = None):
         # Insert base record with user_id
         analysis_doc = {
             "video_url": file_url,
+            "file_name": file_name,
             "video_name": file.filename,
             "analysis_status": "processing",
             "duration": 0,
             "transitions": [],
             "user_id": current_user["id"] if current_user else None,
-            "created_date": datetime.datetime.now(datetime.timezone.utc)
+            "version": 1,
+            "created_date": mongo_utcnow()
         }
 
         result = await app.mongodb["VideoAnalysis"].insert_one(analysis_doc)
-        new_doc = await app.mongodb["VideoAnalysis"].find_one({"_id": result.inserted_id})
+        analysis_doc["_id"] = result.inserted_id
 
         # Start background task safely in a new thread
-        start_background_task(run_transition_analysis, str(new_doc["_id"]), file_path)
+        start_background_task(run_transition_analysis, str(result.inserted_id), file_path)
 
-        return mongo_doc_to_json(new_doc)
+        return mongo_doc_to_json(analysis_doc)
 
     except Exception as e:
         import traceback
@@ -201,9 +242,15 @@ async def analyze_video(file: UploadFile = File(...), request: Request = None):
 
 
 @app.post(f"{API_PREFIX}/analyze-audio")
-async def analyze_audio(file: UploadFile = File(...)):
+async def analyze_audio(file: UploadFile = File(...), request: Request = None):
     """Upload audio, store in Mongo, and start beat detection."""
     try:
+        # Owner is optional here; anonymous uploads can be polled but not re-analyzed
+        try:
+            current_user = await get_current_user(request) if request else None
+        except HTTPException:
+            current_user = None
+
         file_name = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
         file_path = os.path.join(UPLOAD_DIR, file_name)
 
@@ -216,21 +263,24 @@ async def analyze_audio(file: UploadFile = File(...)):
 
         beat_doc = {
             "audio_url": file_url,
+            "file_name": file_name,
             "audio_name": file.filename,
             "analysis_status": "processing",
             "duration": 0,
             "beats": [],
             "strongBeats": [],
             "tempo": 0,
-            "created_date": datetime.datetime.now(datetime.timezone.utc)
+            "user_id": current_user["id"] if current_user else None,
+            "version": 1,
+            "created_date": mongo_utcnow()
         }
 
         result = await app.mongodb["BeatAnalysis"].insert_one(beat_doc)
-        new_doc = await app.mongodb["BeatAnalysis"].find_one({"_id": result.inserted_id})
+        beat_doc["_id"] = result.inserted_id
 
-        start_background_task(run_madmom_beat_analysis, str(new_doc["_id"]), file_path)
+        start_background_task(run_madmom_beat_analysis, str(result.inserted_id), file_path)
 
-        return mongo_doc_to_json(new_doc)
+        return mongo_doc_to_json(beat_doc)
 
     except Exception as e:
         import traceback
@@ -252,6 +302,13 @@ async def core_upload_file(file: UploadFile = File(...)):
             buffer.write(content)
 
         file_url = f"{BASE_URL}{UPLOAD_URL_PATH}/{file_name}"
+
+        # Record the upload so storage cleanup does not treat it as orphaned
+        await app.mongodb["Uploads"].insert_one({
+            "file_name": file_name,
+            "file_url": file_url,
+            "uploaded_date": datetime.datetime.now(datetime.timezone.utc)
+        })
         return {"file_url": file_url}
     except Exception as e:
         import traceback
@@ -352,16 +409,18 @@ async def create_video_analysis(data: dict, request: Request):
         analysis_doc = {
             "user_id": user_id,
             "video_url": data.get("video_url"),
+            "file_name": upload_name_from_url(data.get("video_url")),
             "video_name": data.get("video_name"),
             "analysis_status": data.get("analysis_status", "pending"),
             "duration": data.get("duration"),
             "transitions": data.get("transitions", []),
-            "created_date": datetime.datetime.utcnow()
+            "version": 1,
+            "created_date": mongo_utcnow()
         }
         
         result = await app.mongodb["VideoAnalysis"].insert_one(analysis_doc)
-        new_doc = await app.mongodb["VideoAnalysis"].find_one({"_id": result.inserted_id})
-        return mongo_doc_to_json(new_doc)
+        analysis_doc["_id"] = result.inserted_id
+        return mongo_doc_to_json(analysis_doc)
         
     except HTTPException:
         raise
@@ -382,7 +441,7 @@ async def list_analyses(request: Request):
         # Filter by user_id
         for doc in sync_db["VideoAnalysis"].find({"user_id": user_id}).sort("created_date", -1).limit(100):
             docs.append(mongo_doc_to_json(doc))
-        return docs
+        return json_response(docs)
     except HTTPException:
         # If no auth, return empty list
         return []
@@ -400,20 +459,87 @@ async def get_analysis_status(id: str, request: Request):
     except HTTPException:
         user_id = None
 
-    # Check VideoAnalysis
     query = {"_id": ObjectId(id)}
     if user_id:
         query["user_id"] = user_id
-    
-    doc = await app.mongodb["VideoAnalysis"].find_one(query)
-    if doc:
-        return mongo_doc_to_json(doc)
 
-    doc = await app.mongodb["BeatAnalysis"].find_one(query)
-    if doc:
-        return mongo_doc_to_json(doc)
+    # Look up only the version first so unchanged polls skip the large arrays
+    for collection in ("VideoAnalysis", "BeatAnalysis"):
+        head = await app.mongodb[collection].find_one(query, {"version": 1})
+        if head:
+            break
+    else:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    etag = analysis_etag(head)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    doc = await app.mongodb[collection].find_one(query)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    headers["ETag"] = analysis_etag(doc)
+    return json_response(mongo_doc_to_json(doc), headers)
+
 
-    raise HTTPException(status_code=404, detail="Document not found")
+@app.post(f"{API_PREFIX}/analyses/{{id}}/reanalyze")
+async def reanalyze(id: str, params: dict, request: Request):
+    """Re-run only the post-processing stage against stored features (user-owned only).
+
+    Beat analyses accept `min_bpm`/`max_bpm`; video analyses accept `threshold`.
+    """
+    if not ObjectId.is_valid(id):
+        raise HTTPException(status_code=400, detail="Invalid ID format")
+
+    try:
+        current_user = await get_current_user(request)
+        user_id = current_user["id"]
+    except HTTPException:
+        raise HTTPException(status_code=401, detail="Authentication required")
+
+    query = {"_id": ObjectId(id), "user_id": user_id}
+
+    collection = "VideoAnalysis"
+    doc = await app.mongodb[collection].find_one(query)
+    if not doc:
+        collection = "BeatAnalysis"
+        doc = await app.mongodb[collection].find_one(query)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Analysis not found or not owned by user")
+    if doc.get("analysis_status") != "completed":
+        raise HTTPException(status_code=409, detail="Analysis has not completed yet")
+
+    file_path = upload_path_from_url(doc.get("audio_url") or doc.get("video_url"))
+    try:
+        if not file_path:
+            raise FileNotFoundError(id)
+        if collection == "BeatAnalysis":
+            try:
+                min_bpm, max_bpm = validate_bpm_range(params.get("min_bpm"), params.get("max_bpm"))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            activations = load_features(file_path, "beats")
+            beats, tempo = await run_in_threadpool(track_beats, activations, min_bpm, max_bpm)
+            updates = {"beats": beats, "tempo": tempo, "min_bpm": min_bpm, "max_bpm": max_bpm}
+        else:
+            threshold = float(params.get("threshold", CUT_THRESHOLD))
+            if not CANDIDATE_THRESHOLD <= threshold <= 1.0:
+                raise HTTPException(status_code=400, detail=f"threshold must be between {CANDIDATE_THRESHOLD} and 1.0")
+            cuts = load_features(file_path, "cuts")
+            updates = {"transitions": select_cuts(cuts, threshold=threshold), "cut_threshold": threshold}
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid re-analysis parameters")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No stored features for this analysis; re-upload to analyze it")
+
+    updates["processed_at"] = datetime.datetime.now(datetime.timezone.utc)
+    doc = await app.mongodb[collection].find_one_and_update(
+        {"_id": doc["_id"]},
+        {"$set": updates, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    return mongo_doc_to_json(doc)
 
 
 @app.post(f"{API_PREFIX}/analyses/{{id}}")
@@ -429,20 +555,22 @@ async def update_analysis(id: str, updates: dict, request: Request):
     except HTTPException:
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    # Remove _id and id from updates if present
+    # Remove _id, id and version from updates if present
     updates.pop("_id", None)
     updates.pop("id", None)
+    updates.pop("version", None)
+    if "video_url" in updates:
+        updates["file_name"] = upload_name_from_url(updates["video_url"])
     
-    result = await app.mongodb["VideoAnalysis"].update_one(
+    doc = await app.mongodb["VideoAnalysis"].find_one_and_update(
         {"_id": ObjectId(id), "user_id": user_id},
-        {"$set": updates}
+        {"$set": updates, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if doc is None:
         raise HTTPException(status_code=404, detail="Analysis not found or not owned by user")
     
-    # Return updated document
-    doc = await app.mongodb["VideoAnalysis"].find_one({"_id": ObjectId(id)})
     return mongo_doc_to_json(doc)
 
 
@@ -458,11 +586,19 @@ async def delete_analysis(id: str, request: Request):
     except HTTPException:
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    result = await app.mongodb["VideoAnalysis"].delete_one({"_id": ObjectId(id), "user_id": user_id})
+    doc = await app.mongodb["VideoAnalysis"].find_one_and_delete(
+        {"_id": ObjectId(id), "user_id": user_id},
+        projection={"video_url": 1}
+    )
     
-    if result.deleted_count == 0:
+    if doc is None:
         raise HTTPException(status_code=404, detail="Analysis not found or not owned by user")
     
+    # Delete uploaded video and stored features from filesystem
+    file_path = upload_path_from_url(doc.get("video_url"))
+    if file_path:
+        remove_upload(file_path)
+    
     return {"success": True, "id": id}
 
 
@@ -7,6 +7,7 @@ import cv2
 import datetime
 import os
 import random
+from typing import Optional
 from dotenv import load_dotenv
 
 # --- Load Env ---
@@ -31,78 +32,263 @@ def start_background_task(fn, *args):
     thread.daemon = True
     thread.start()
 
+# --- Stored Features ---
+# Expensive intermediates are kept next to each upload as .npy files so that
+# re-analysis with new parameters only runs the cheap post-processing stage.
+BEAT_FPS = 100
+DEFAULT_MIN_BPM = 55.0   # madmom DBNBeatTrackingProcessor defaults
+DEFAULT_MAX_BPM = 215.0
+BPM_LIMITS = (20.0, 400.0)  # outside this the DBN state space degenerates or explodes
+FEATURE_KINDS = ("beats", "cuts")
+
+def feature_path(file_path: str, kind: str) -> str:
+    return f"{file_path}.{kind}.npy"
+
+def save_features(file_path: str, kind: str, data) -> None:
+    np.save(feature_path(file_path, kind), np.ascontiguousarray(data))
+
+def remove_upload(file_path: str) -> int:
+    """Delete an upload and its stored features; returns bytes freed."""
+    freed = 0
+    for path in [file_path] + [feature_path(file_path, kind) for kind in FEATURE_KINDS]:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+    return freed
+
+def load_features(file_path: str, kind: str):
+    """Memory-map a stored feature array; raises FileNotFoundError if absent."""
+    return np.load(feature_path(file_path, kind), mmap_mode="r")
+
 # --- Beat Analysis ---
+def track_beats(activations, min_bpm: Optional[float] = None, max_bpm: Optional[float] = None):
+    """Run the DBN tracker and tempo estimation over RNN beat activations.
+
+    A missing bound falls back to madmom's default for that processor.
+    """
+    bpm_range = {k: v for k, v in (("min_bpm", min_bpm), ("max_bpm", max_bpm)) if v is not None}
+    activations = np.asarray(activations, dtype=np.float32)
+    dbn = madmom.features.beats.DBNBeatTrackingProcessor(fps=BEAT_FPS, **bpm_range)
+    beats = dbn(activations)
+
+    tempo_proc = madmom.features.tempo.TempoEstimationProcessor(fps=BEAT_FPS, **bpm_range)
+    tempo = int(tempo_proc(activations)[0][0]) if len(beats) else 0
+    return [{"timestamp": float(b)} for b in beats], tempo
+
+def validate_bpm_range(min_bpm: Optional[float], max_bpm: Optional[float]):
+    """Parse caller-supplied BPM bounds and check the range the tracker will use.
+
+    A missing bound stays None (so each processor keeps its own default, as in
+    the original analysis) but is checked as the DBN default. Raises ValueError
+    unless BPM_LIMITS[0] <= min_bpm < max_bpm <= BPM_LIMITS[1].
+    """
+    min_bpm = None if min_bpm is None else float(min_bpm)
+    max_bpm = None if max_bpm is None else float(max_bpm)
+    low = DEFAULT_MIN_BPM if min_bpm is None else min_bpm
+    high = DEFAULT_MAX_BPM if max_bpm is None else max_bpm
+    lo_limit, hi_limit = BPM_LIMITS
+    # NaN fails every comparison, so it is rejected here too
+    if not (lo_limit <= low < high <= hi_limit):
+        raise ValueError(f"BPM range must satisfy {lo_limit:g} <= min_bpm < max_bpm <= {hi_limit:g} "
+                         f"(got {low:g}, {high:g})")
+    return min_bpm, max_bpm
+
 def run_madmom_beat_analysis(task_id: str, file_path: str):
     print(f"[Task {task_id}] Starting beat analysis...")
     db = get_db()
     col = db["BeatAnalysis"]
 
     try:
-        FPS = 100
         rnn = madmom.features.beats.RNNBeatProcessor()
-        activations = rnn(file_path)
-        dbn = madmom.features.beats.DBNBeatTrackingProcessor(fps=FPS)
-        beats = dbn(activations)
-
-        tempo_proc = madmom.features.tempo.TempoEstimationProcessor(fps=FPS)
-        tempo = int(tempo_proc(activations)[0][0]) if len(beats) else 0
+        activations = rnn(file_path).astype(np.float32)
+        save_features(file_path, "beats", activations)
+        beats, tempo = track_beats(activations)
 
         duration = madmom.audio.signal.Signal(file_path).length / 44100
 
         updates = {
             "analysis_status": "completed",
             "duration": duration,
-            "beats": [{"timestamp": float(b)} for b in beats],
+            "beats": beats,
             "tempo": tempo,
             "processed_at": datetime.datetime.now(datetime.timezone.utc)
         }
-        col.update_one({"_id": ObjectId(task_id)}, {"$set": updates})
+        col.update_one({"_id": ObjectId(task_id)}, {"$set": updates, "$inc": {"version": 1}})
         print(f"[Task {task_id}] Beat analysis done, {len(beats)} beats found.")
 
     except Exception as e:
         print(f"❌ Beat analysis failed for {task_id}: {e}")
-        col.update_one({"_id": ObjectId(task_id)}, {"$set": {"analysis_status": "failed", "error": str(e)}})
+        col.update_one({"_id": ObjectId(task_id)}, {"$set": {"analysis_status": "failed", "error": str(e)}, "$inc": {"version": 1}})
 
 
 # --- Transition Analysis ---
-def run_transition_analysis(task_id: str, file_path: str):
-    print(f"[Task {task_id}] Starting transition analysis...")
-    db = get_db()
-    col = db["VideoAnalysis"]
+# Frames are compared on a small grayscale histogram plus a coarse grid of
+# block means, so a cut scores high even when overall brightness barely moves.
+CUT_THRESHOLD = 0.35        # score (0..1) above which a frame change is a cut
+CANDIDATE_THRESHOLD = 0.15  # coarse-pass score that triggers a local search
+QUIET_THRESHOLD = 0.05      # below this the footage is static, widen the step
+HIST_BINS = 32
+BLOCK_GRID = 8
 
-    try:
-        cap = cv2.VideoCapture(file_path)
-        if not cap.isOpened():
-            raise IOError(f"Cannot open video file: {file_path}")
+THUMB_SIZE = 64
+
+def _thumbnail(frame, stride: int):
+    # Strided copy so a window of skipped frames can be kept without holding full frames
+    return np.ascontiguousarray(frame[::stride, ::stride])
+
+def _frame_signature(thumb):
+    gray = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    hist = cv2.calcHist([small], [0], None, [HIST_BINS], [0, 256])
+    hist /= max(float(hist.sum()), 1.0)
+    blocks = cv2.resize(small, (BLOCK_GRID, BLOCK_GRID), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return hist, blocks
+
+def _frame_difference(a, b) -> float:
+    hist_dist = cv2.compareHist(a[0], b[0], cv2.HISTCMP_BHATTACHARYYA)
+    block_dist = min(1.0, float(np.mean(np.abs(a[1] - b[1]))) / 64.0)
+    return float(min(1.0, max(hist_dist, block_dist)))
+
+def _refine_window(prev_sig, window, last_sig, stats: dict):
+    """Score consecutive frames across a buffered window (whose last frame's
+    signature is already known) and return every (frame_index, score) peak at
+    or above CANDIDATE_THRESHOLD."""
+    scores = []
+    sig = prev_sig
+    for i, (frame_num, thumb) in enumerate(window):
+        if i + 1 < len(window):
+            next_sig = _frame_signature(thumb)
+            stats["scored"] += 1
+        else:
+            next_sig = last_sig
+        scores.append((frame_num, _frame_difference(sig, next_sig)))
+        sig = next_sig
+
+    peaks = []
+    for i, (frame_num, score) in enumerate(scores):
+        left = scores[i - 1][1] if i > 0 else 0.0
+        right = scores[i + 1][1] if i + 1 < len(scores) else 0.0
+        if score >= CANDIDATE_THRESHOLD and score >= left and score > right:
+            peaks.append((frame_num, score))
+    return peaks
 
+def scan_transitions(file_path: str, stats: Optional[dict] = None):
+    """Coarse-to-fine scan of a video.
+
+    Only sparse samples are scored, at an adaptive step (widened up to 2x over
+    static footage, reset to the minimum when the picture changes). Frames
+    between samples are kept as small thumbnails; whenever two samples differ
+    by more than CANDIDATE_THRESHOLD that window is scored frame by frame to
+    locate each exact cut frame. The last decoded frame is always scored so
+    cuts near the end are not missed.
+
+    Every frame is still decoded once, in order: VideoCapture cannot skip
+    decoding, so the saving is in scoring work, not in decoding.
+
+    Returns (fps, duration, samples, candidates) where samples is a list of
+    (frame_index, score) from the sparse pass and candidates is a list of
+    (frame_index, score) for each refined cut candidate. If `stats` is given
+    it receives the number of frames decoded and scored.
+    """
+    cap = cv2.VideoCapture(file_path)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video file: {file_path}")
+
+    stats = stats if stats is not None else {}
+    stats.update(decoded=0, scored=0)
+    try:
         fps = cap.get(cv2.CAP_PROP_FPS) or 30
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count / fps
+        min_step = max(1, int(round(fps / 10)))
+        # Widening is capped at twice the base rate: an insert shorter than the
+        # current step can fall between two samples that show the same scene
+        max_step = 2 * min_step
 
-        frame_analysis = []
-        frame_skip = max(1, int(fps // 10))
+        samples = []
+        candidates = []
+        window = []
+        step = min_step
+        stride = None
+        prev_sig = None
+        next_sample = 0
         frame_num = 0
 
-        while cap.isOpened():
+        while True:
             ret, frame = cap.read()
+            if ret:
+                stats["decoded"] += 1
+                if stride is None:
+                    stride = max(1, min(frame.shape[:2]) // THUMB_SIZE)
+                window.append((frame_num, _thumbnail(frame, stride)))
+                frame_num += 1
+                if frame_num - 1 < next_sample:
+                    continue
+            elif not window:
+                break
+
+            # Score the newest frame against the previous sample
+            sample_num, thumb = window[-1]
+            sig = _frame_signature(thumb)
+            stats["scored"] += 1
+            if prev_sig is None:
+                samples.append((sample_num, 0.0))
+            else:
+                score = _frame_difference(prev_sig, sig)
+                samples.append((sample_num, score))
+                if score >= CANDIDATE_THRESHOLD:
+                    candidates.extend(_refine_window(prev_sig, window, sig, stats))
+                    step = min_step
+                elif score < QUIET_THRESHOLD:
+                    step = min(max_step, step * 2)
+                else:
+                    step = min_step
+            prev_sig = sig
+            window = []
+            next_sample = sample_num + step
             if not ret:
                 break
-            if frame_num % frame_skip == 0:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                brightness = np.mean(gray)
-                frame_analysis.append({"timestamp": frame_num / fps, "brightness": brightness})
-            frame_num += 1
+
+        frame_count = max(frame_count, frame_num)
+    finally:
         cap.release()
 
-        transitions = []
-        for i in range(1, len(frame_analysis)):
-            diff = abs(frame_analysis[i]["brightness"] - frame_analysis[i-1]["brightness"])
-            if diff > 30:
-                transitions.append({
-                    "timestamp": frame_analysis[i]["timestamp"],
-                    "type": "cut",
-                    "confidence": min(1.0, diff / 100)
-                })
+    return fps, frame_count / fps, samples, candidates
+
+def select_cuts(candidates, fps: float = 1.0, threshold: float = CUT_THRESHOLD):
+    """Turn refined (frame_index, score) candidates into transition records.
+
+    With the default fps of 1.0 the first column is taken as seconds, which is
+    how candidates are stored on disk.
+    """
+    return [
+        {
+            "timestamp": float(frame_index) / fps,
+            "type": "cut",
+            "confidence": round(float(score), 4)
+        }
+        for frame_index, score in candidates
+        if score >= threshold
+    ]
+
+def _frames_to_seconds(rows, fps: float):
+    # Stored in seconds so re-analysis does not need the frame rate
+    arr = np.array(rows, dtype=np.float64).reshape(-1, 2)
+    arr[:, 0] /= fps
+    return arr
+
+def run_transition_analysis(task_id: str, file_path: str):
+    print(f"[Task {task_id}] Starting transition analysis...")
+    db = get_db()
+    col = db["VideoAnalysis"]
+
+    try:
+        fps, duration, samples, candidates = scan_transitions(file_path)
+        transitions = select_cuts(candidates, fps)
+
+        save_features(file_path, "cuts", _frames_to_seconds(candidates, fps))
 
         updates = {
             "analysis_status": "completed",
@@ -110,9 +296,10 @@ def run_transition_analysis(task_id: str, file_path: str):
             "transitions": transitions,
             "processed_at": datetime.datetime.now(datetime.timezone.utc)
         }
-        col.update_one({"_id": ObjectId(task_id)}, {"$set": updates})
-        print(f"[Task {task_id}] Transition analysis done, {len(transitions)} transitions found.")
+        col.update_one({"_id": ObjectId(task_id)}, {"$set": updates, "$inc": {"version": 1}})
+        print(f"[Task {task_id}] Transition analysis done, {len(transitions)} transitions found "
+              f"({len(samples)} sparse samples, {len(candidates)} cut peaks).")
 
     except Exception as e:
         print(f"❌ Transition analysis failed for {task_id}: {e}")
-        col.update_one({"_id": ObjectId(task_id)}, {"$set": {"analysis_status": "failed", "error": str(e)}})
+        col.update_one({"_id": ObjectId(task_id)}, {"$set": {"analysis_status": "failed", "error": str(e)}, "$inc": {"version": 1}})
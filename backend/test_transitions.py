@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Synthetic-clip check for transition detection: cut frames must come back
+exactly, and sparse sampling must score far fewer frames than it decodes.
+"""
+import os
+import tempfile
+from fixtures import make_video_fixture
+from tasks import scan_transitions, select_cuts
+
+CLIPS = [
+    # (seconds, fps, codec, extension, ground-truth cut frames, scene after each cut)
+    (10, 30, "MJPG", "avi", [45, 150, 155, 160, 295], None),
+    (30, 30, "mp4v", "mp4", [300, 888], None),
+    # Short insert of scene B into static scene A: the samples either side both show A
+    (10, 30, "MJPG", "avi", [100, 108], [1, 0]),
+]
+
+
+def check_clip(seconds, fps, fourcc, ext, expected, scenes):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"clip.{ext}")
+        make_video_fixture(path, seconds=seconds, fps=fps, cuts=expected, fourcc=fourcc, scenes=scenes)
+        stats = {}
+        clip_fps, _, _, candidates = scan_transitions(path, stats)
+
+    found = [round(t["timestamp"] * clip_fps) for t in select_cuts(candidates, clip_fps)]
+    assert found == expected, f"{fourcc}: expected cuts {expected}, got {found}"
+    assert stats["decoded"] == seconds * fps, f"{fourcc}: decoded {stats['decoded']} frames"
+    assert stats["scored"] < stats["decoded"] / 2, f"{fourcc}: scored {stats['scored']} frames"
+    return stats
+
+
+def test_cut_frames_exact():
+    for clip in CLIPS:
+        check_clip(*clip)
+
+
+if __name__ == "__main__":
+    for clip in CLIPS:
+        stats = check_clip(*clip)
+        print(f"✅ {clip[2]}: cuts {clip[4]} found, {stats['decoded']} frames decoded, {stats['scored']} scored")